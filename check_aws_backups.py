@@ -23,28 +23,37 @@ __license__ = "GPLv2"
 __version__ = "0.1.0"
 
 import argparse
-import boto3
 from datetime import datetime, timedelta
+import functools
+import hashlib
+import itertools
+import json
+import os
+import stat
 import sys
 import logging
-import traceback
-import operator
+import tempfile
+import time
 
 # Constants
 ###############################################################################
 _STDERR_OUTPUT_LEVEL = logging.CRITICAL  # Leave at logging.CRITICAL unless doing debugging
 _PRINT_STACKTRACE_ON_ERROR = False  # Show stacktrace to stderr on error
+_FAST_EXIT = True  # Skip interpreter teardown (atexit, open sockets) on exit; set False when debugging
 _EXIT_OK = [0, 'OK']
 _EXIT_WARNING = [1, 'WARNING']
 _EXIT_CRITICAL = [2, 'CRITICAL']
 _EXIT_UNKNOWN = [3, 'UNKNOWN']
+_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'icinga_aws_cache-{uid}'.format(uid=os.getuid()))  # Used when --cache_ttl is greater than 0
 
 
 # Functions
 ###############################################################################
 def _get_logger():
   _root_logger = logging.getLogger()
-  _root_logger.setLevel(logging.DEBUG)
+  # Gate on the logger too so disabled debug/info calls return before building a record.  The handler level still
+  # applies to records from library loggers (urllib3, botocore), which only check their own level
+  _root_logger.setLevel(_STDERR_OUTPUT_LEVEL)
   _formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
   _stderr_logger = logging.StreamHandler()
   _stderr_logger.setFormatter(_formatter)
@@ -59,13 +68,18 @@ def _get_logger():
 
 # noinspection DuplicatedCode
 def _get_args():
+  def _set_logging_level(_level):
+    _logger.setLevel(_level)
+    for _handler in _logger.handlers:
+      _handler.setLevel(_level)
+
   def _update_logging_level():
     if _args.verbose:
-      _logger.setLevel(logging.INFO)
+      _set_logging_level(logging.INFO)
       _logger.info('Logger level set to INFO')
     elif _args.debug:
-      _logger.setLevel(logging.DEBUG)
-    _logger.info('Logger level set to DEBUG')
+      _set_logging_level(logging.DEBUG)
+      _logger.info('Logger level set to DEBUG')
     return
 
   try:
@@ -79,29 +93,45 @@ def _get_args():
     _parser.add_argument('-c', '--critical', metavar='CRITICAL', action='store', help='Value (INT) for WARNING if greater than FAILED count (default: %(default)s)', dest='critical', type=int, default=0)
     _parser.add_argument('-r', '--aws_region', metavar='AWS_REGION', required=True, action='store', help='AWS region (Example: us-east-1)', dest='aws_region', type=str)
     _parser.add_argument('-p', '--aws_profile', metavar='AWS_PROFILE', action='store', help='AWS profile', dest='aws_profile', type=str)
+    _parser.add_argument('-t', '--cache_ttl', metavar='CACHE_TTL', action='store', help='Seconds (INT) to reuse a cached AWS response; 0 disables the cache (default: %(default)s)', dest='cache_ttl', type=int, default=0)
     _parser.add_argument('-v', '--verbose', required=False, action='store_true', help='Verbose output to stderr', dest='verbose')
     _parser.add_argument('-vv', '--debug', required=False, action='store_true', help='Debug output to stderr', dest='debug')
     _args = _parser.parse_args()
     _update_logging_level()
-    _logger.debug('Args: {0}'.format(vars(_args)))
+    _logger.debug('Args: %s', vars(_args))
     return _args
   except Exception as err:
     _print_stacktrace(err)
     _print_result([_EXIT_UNKNOWN, 'Unknown error parsing arguments'])
 
 
-def _get_aws_client(_args):
+# Cached so repeated _main() calls in a long-lived process reuse the session and its connection pool
+@functools.lru_cache(maxsize=8)
+def _get_aws_client(_aws_region, _aws_profile):
   try:
     _logger.info('Get AWS client')
+    # Imported here so --help and argument errors don't pay for loading boto3
+    import boto3
+    from botocore.config import Config
     _session_args = {
-      'region_name': _args.aws_region
+      'region_name': _aws_region
     }
-    if hasattr(_args, 'aws_profile'):
-      _session_args['profile_name'] = _args.aws_profile
+    if _aws_profile is not None:
+      _session_args['profile_name'] = _aws_profile
 
-    _logger.debug('Session args: {0}'.format(_session_args))
+    _logger.debug('Session args: %s', _session_args)
+    _client_config = Config(
+      tcp_keepalive=True,
+      max_pool_connections=10,
+      connect_timeout=3,
+      read_timeout=15,
+      retries={
+        'max_attempts': 3,
+        'mode': 'standard'
+      }
+    )
     _session = boto3.Session(**_session_args)
-    _client = _session.client(service_name='backup')
+    _client = _session.client(service_name='backup', config=_client_config)
     _logger.info('AWS client created')
     return _client
   except Exception as err:
@@ -110,10 +140,28 @@ def _get_aws_client(_args):
 
 
 def _get_check_result(_args, _aws_client):
+  def _get_backup_job_pages():
+    nonlocal _truncated
+    _failed_count = 0
+    _paginator = _aws_client.get_paginator('list_backup_jobs')
+    for _page_index, _page in enumerate(_paginator.paginate(**_request_args)):
+      _logger.debug('Response BackupJobs page %d: count=%d first=%s', _page_index, len(_page['BackupJobs']), _page['BackupJobs'][0] if _page['BackupJobs'] else None)
+      yield _page['BackupJobs']
+      # Only FAILED jobs are returned; once past CRITICAL the remaining pages cannot change the result
+      _failed_count += len(_page['BackupJobs'])
+      if _failed_count > _args.critical:
+        # A NextToken means there were pages left, so the count is only a lower bound
+        _truncated = 'NextToken' in _page
+        _logger.info('CRITICAL threshold exceeded; stop paging backup jobs (truncated: %s)', _truncated)
+        return
+
   try:
     _logger.info('Get check result')
     _request_args = {
-      'MaxResults': 1000
+      'ByState': 'FAILED',
+      'PaginationConfig': {
+        'PageSize': 1000
+      }
     }
     if _args.resource_arn is not None:
       _request_args['ByResourceArn'] = _args.resource_arn
@@ -123,44 +171,94 @@ def _get_check_result(_args, _aws_client):
       _request_args['ByResourceType'] = _args.resource_type
     _request_args['ByCreatedAfter'] = datetime.utcnow() - timedelta(hours=_args.period)
 
-    _backup_jobs = []
-    while True:
-      _response = _aws_client.list_backup_jobs(**_request_args)
-      _logger.debug('Response BackupJobs: {0}'.format(_response['BackupJobs']))
-      _backup_jobs.extend(_response['BackupJobs'])
-      if 'NextToken' in _response:
-        _request_args['NextToken'] = _response['NextToken']
-      else:
-        break
-    return _backup_jobs
+    _truncated = False
+    _backup_jobs = list(itertools.chain.from_iterable(_get_backup_job_pages()))
+    return {
+      'BackupJobs': _backup_jobs,
+      'Truncated': _truncated
+    }
   except Exception as err:
     _print_stacktrace(err)
     _print_result([_EXIT_UNKNOWN, 'Unknown error getting backup job list'])
 
 
+def _get_cache_dir():
+  # The cache sits under the shared temp directory; only use it if it is a real directory private to this user
+  os.makedirs(_CACHE_DIR, mode=0o700, exist_ok=True)
+  _dir_stat = os.lstat(_CACHE_DIR)
+  if not stat.S_ISDIR(_dir_stat.st_mode) or _dir_stat.st_uid != os.getuid() or _dir_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+    raise OSError('{dir} is not a private directory owned by this user'.format(dir=_CACHE_DIR))
+  return _CACHE_DIR
+
+
+def _get_cache_file(_args):
+  _cache_args = sorted((_key, _value) for _key, _value in vars(_args).items() if _key not in ('verbose', 'debug', 'cache_ttl'))
+  _cache_key = hashlib.sha1(repr(('backup', _cache_args)).encode()).hexdigest()
+  return os.path.join(_get_cache_dir(), '{key}.json'.format(key=_cache_key))
+
+
+def _read_cache(_args):
+  if _args.cache_ttl <= 0:
+    return None
+  try:
+    _cache_file = _get_cache_file(_args)
+    # O_NOFOLLOW + fstat checks the file actually opened, not whatever the path pointed at a moment earlier
+    with os.fdopen(os.open(_cache_file, os.O_RDONLY | os.O_NOFOLLOW)) as _cache:
+      _cache_stat = os.fstat(_cache.fileno())
+      if _cache_stat.st_uid != os.getuid() or time.time() - _cache_stat.st_mtime > _args.cache_ttl:
+        _logger.info('Cache stale or not owned by this user: %s', _cache_file)
+        return None
+      _check_result = json.load(_cache)
+    _logger.info('Check result read from cache: %s', _cache_file)
+    return _check_result
+  except Exception as err:
+    _logger.info('Cache not used: %s', err)
+    return None
+
+
+def _write_cache(_args, _check_result):
+  if _args.cache_ttl <= 0:
+    return
+  try:
+    _cache_file = _get_cache_file(_args)
+    _tmp_fd, _tmp_file = tempfile.mkstemp(dir=os.path.dirname(_cache_file), suffix='.tmp')
+    try:
+      with os.fdopen(_tmp_fd, 'w') as _cache:
+        json.dump(_check_result, _cache, default=str)
+      os.replace(_tmp_file, _cache_file)
+    except Exception:
+      os.unlink(_tmp_file)
+      raise
+    _logger.info('Check result written to cache: %s', _cache_file)
+  except Exception as err:
+    _print_stacktrace(err)
+    _logger.info('Cache not written: %s', err)
+
+
 def _print_result(_result):
   sys.stdout.write('AWS-BACKUP {status} - {info_text}'.format(status=_result[0][1], info_text=_result[1]))
+  if _FAST_EXIT:
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(_result[0][0])
   sys.exit(_result[0][0])
 
 
 def _print_stacktrace(_stacktrace):
   if _PRINT_STACKTRACE_ON_ERROR:
+    import traceback
     traceback.print_exc(file=sys.stderr)
 
 
 def _analyze_result(_args, _check_result):
   _logger.info('Analyze results')
-  _result_counts = {}
-  for _result in _check_result:
-    if _result['State'] in _result_counts:
-      _result_counts[_result['State']] += 1
-    else:
-      _result_counts[_result['State']] = 1
-
-  _result_txt = '{count} in last {period} hours'.format(count=_result_counts, period=_args.period)
-  if 'FAILED' in _result_counts and _result_counts['FAILED'] > _args.critical:
+  # Only FAILED jobs are requested, so every returned job counts
+  _failed_count = len(_check_result['BackupJobs'])
+
+  _result_txt = '{qualifier}{failed} FAILED in last {period} hours'.format(qualifier='at least ' if _check_result['Truncated'] else '', failed=_failed_count, period=_args.period)
+  if _failed_count > _args.critical:
     return [_EXIT_CRITICAL, _result_txt]
-  elif 'FAILED' in _result_counts and _result_counts['FAILED'] > _args.warning:
+  elif _failed_count > _args.warning:
     return [_EXIT_WARNING, _result_txt]
   else:
     return [_EXIT_OK, _result_txt]
@@ -171,8 +269,11 @@ def _analyze_result(_args, _check_result):
 def _main():
   _logger.info('Begin main')
   _args = _get_args()
-  _aws_client = _get_aws_client(_args)
-  _check_result = _get_check_result(_args, _aws_client)
+  _check_result = _read_cache(_args)
+  if _check_result is None:
+    _aws_client = _get_aws_client(_args.aws_region, _args.aws_profile)
+    _check_result = _get_check_result(_args, _aws_client)
+    _write_cache(_args, _check_result)
   _analyzed_result = _analyze_result(_args, _check_result)
   _print_result(_analyzed_result)
   _logger.info('Finish main')
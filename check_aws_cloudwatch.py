@@ -23,28 +23,45 @@ __license__ = "GPLv2"
 __version__ = "0.1.0"
 
 import argparse
-import boto3
 from datetime import datetime, timedelta
+import functools
+import hashlib
+import json
+import os
+import stat
 import sys
 import logging
-import traceback
+import tempfile
+import time
 import operator
 
 # Constants
 ###############################################################################
 _STDERR_OUTPUT_LEVEL = logging.CRITICAL  # Leave at logging.CRITICAL unless doing debugging
 _PRINT_STACKTRACE_ON_ERROR = False  # Show stacktrace to stderr on error
+_FAST_EXIT = True  # Skip interpreter teardown (atexit, open sockets) on exit; set False when debugging
 _EXIT_OK = [0, 'OK']
 _EXIT_WARNING = [1, 'WARNING']
 _EXIT_CRITICAL = [2, 'CRITICAL']
 _EXIT_UNKNOWN = [3, 'UNKNOWN']
+_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'icinga_aws_cache-{uid}'.format(uid=os.getuid()))  # Used when --cache_ttl is greater than 0
+_COMPARATORS = {
+  'gt': operator.gt,
+  'ge': operator.ge,
+  'lt': operator.lt,
+  'le': operator.le,
+  'eq': operator.eq,
+  'ne': operator.ne
+}
 
 
 # Functions
 ###############################################################################
 def _get_logger():
   _root_logger = logging.getLogger()
-  _root_logger.setLevel(logging.DEBUG)
+  # Gate on the logger too so disabled debug/info calls return before building a record.  The handler level still
+  # applies to records from library loggers (urllib3, botocore), which only check their own level
+  _root_logger.setLevel(_STDERR_OUTPUT_LEVEL)
   _formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
   _stderr_logger = logging.StreamHandler()
   _stderr_logger.setFormatter(_formatter)
@@ -58,13 +75,18 @@ def _get_logger():
 
 
 def _get_args():
+  def _set_logging_level(_level):
+    _logger.setLevel(_level)
+    for _handler in _logger.handlers:
+      _handler.setLevel(_level)
+
   def _update_logging_level():
     if _args.verbose:
-      _logger.setLevel(logging.INFO)
+      _set_logging_level(logging.INFO)
       _logger.info('Logger level set to INFO')
     elif _args.verboseverbose:
-      _logger.setLevel(logging.DEBUG)
-    _logger.info('Logger level set to DEBUG')
+      _set_logging_level(logging.DEBUG)
+      _logger.info('Logger level set to DEBUG')
     return
 
   try:
@@ -75,36 +97,53 @@ def _get_args():
     _parser.add_argument('-M', '--metric', metavar='METRIC', required=True, action='store', help='Cloudwatch metric (Example: FreeStorageSpace)', dest='metric', type=str)
     _parser.add_argument('-s', '--statistic', metavar='STATISTIC', action='store', help='Cloudwatch statistic (default: %(default)s) (choices: %(choices)s)', dest='statistic', type=str,
                          choices=['SampleCount', 'Average', 'Sum', 'Minimum', 'Maximum'], default='Average')
+    _parser.add_argument('-u', '--unit', metavar='UNIT', action='store', help='Cloudwatch unit to request and report (Example: Bytes)', dest='unit', type=str)
     _parser.add_argument('-P', '--period', metavar='PERIOD', help='Period (SECONDS) for statistics range (default: %(default)s)', dest='period', type=int, default=300)
     _parser.add_argument('-w', '--warning', metavar='WARNING', required=True, action='store', help='Value (FLOAT) for WARNING status/exit', dest='warning', type=float)
     _parser.add_argument('-c', '--critical', metavar='CRITICAL', required=True, action='store', help='Value (FLOAT) for WARNING status/exit', dest='critical', type=float)
     _parser.add_argument('-C', '--comparator', metavar='COMPARATOR', required=True, action='store', help='Comparator for the WARNING/CRITICAL against returned value for metric (choices: %(choices)s)', dest='comparator', type=str,
-                         choices=['gt', 'ge', 'lt', 'le', 'eq', 'ne'])
+                         choices=list(_COMPARATORS))
     _parser.add_argument('-r', '--aws_region', metavar='AWS_REGION', required=True, action='store', help='AWS region (Example: us-east-1)', dest='aws_region', type=str)
     _parser.add_argument('-p', '--aws_profile', metavar='AWS_PROFILE', action='store', help='AWS profile', dest='aws_profile', type=str)
+    _parser.add_argument('-t', '--cache_ttl', metavar='CACHE_TTL', action='store', help='Seconds (INT) to reuse a cached AWS response; 0 disables the cache (default: %(default)s)', dest='cache_ttl', type=int, default=0)
     _parser.add_argument('-v', '--verbose', required=False, action='store_true', help='Verbose output to stderr', dest='verbose')
     _parser.add_argument('-vv', '--verboseverbose', required=False, action='store_true', help='Debug output to stderr', dest='verboseverbose')
     _args = _parser.parse_args()
     _update_logging_level()
-    _logger.debug('Args: {0}'.format(vars(_args)))
+    _logger.debug('Args: %s', vars(_args))
     return _args
   except Exception as err:
     _print_stacktrace(err)
     _print_result([_EXIT_UNKNOWN, 'Unknown error parsing arguments'])
 
 
-def _get_aws_client(_args):
+# Cached so repeated _main() calls in a long-lived process reuse the session and its connection pool
+@functools.lru_cache(maxsize=8)
+def _get_aws_client(_aws_region, _aws_profile):
   try:
     _logger.info('Get AWS client')
+    # Imported here so --help and argument errors don't pay for loading boto3
+    import boto3
+    from botocore.config import Config
     _session_args = {
-      'region_name': _args.aws_region
+      'region_name': _aws_region
     }
-    if hasattr(_args, 'aws_profile'):
-      _session_args['profile_name'] = _args.aws_profile
+    if _aws_profile is not None:
+      _session_args['profile_name'] = _aws_profile
 
-    _logger.debug('Session args: {0}'.format(_session_args))
+    _logger.debug('Session args: %s', _session_args)
+    _client_config = Config(
+      tcp_keepalive=True,
+      max_pool_connections=10,
+      connect_timeout=3,
+      read_timeout=15,
+      retries={
+        'max_attempts': 3,
+        'mode': 'standard'
+      }
+    )
     _session = boto3.Session(**_session_args)
-    _client = _session.client(service_name='cloudwatch')
+    _client = _session.client(service_name='cloudwatch', config=_client_config)
     _logger.info('AWS client created')
     return _client
   except Exception as err:
@@ -113,52 +152,120 @@ def _get_aws_client(_args):
 
 
 def _get_check_result(_args, _aws_client):
-  def _build_dimensions():
-    _dimensions = []
-    for _dimension_set in _args.dimensions.split(','):
-      _parts = _dimension_set.split('=')
-      _dimensions.append({
-        'Name': _parts[0],
-        'Value': _parts[1]
-      })
-      _logger.debug('Dimensions: {0}'.format(_dimensions))
-    return _dimensions
-
   try:
     _logger.info('Get check result')
-    _response = _aws_client.get_metric_statistics(
-      Namespace=_args.namespace,
-      MetricName=_args.metric,
-      Dimensions=_build_dimensions(),
-      StartTime=datetime.utcnow() - timedelta(seconds=_args.period),
-      EndTime=datetime.utcnow(),
-      Period=_args.period,
-      Statistics=[_args.statistic]
+    _dimensions = [{'Name': _name, 'Value': _value} for _name, _value in (_dimension_set.split('=', 1) for _dimension_set in _args.dimensions.split(','))]
+    _logger.debug('Dimensions: %s', _dimensions)
+    _now = datetime.utcnow()
+    _metric_stat = {
+      'Metric': {
+        'Namespace': _args.namespace,
+        'MetricName': _args.metric,
+        'Dimensions': _dimensions
+      },
+      'Period': _args.period,
+      'Stat': _args.statistic
+    }
+    if _args.unit is not None:
+      _metric_stat['Unit'] = _args.unit
+    _response = _aws_client.get_metric_data(
+      MetricDataQueries=[
+        {
+          'Id': 'm1',
+          'MetricStat': _metric_stat
+        }
+      ],
+      StartTime=_now - timedelta(seconds=_args.period),
+      EndTime=_now,
+      ScanBy='TimestampDescending'
     )
-    _logger.debug('Response Datapoints: {0}'.format(_response['Datapoints']))
-    return _response['Datapoints']
+    _logger.debug('Response MetricDataResults: %s', _response['MetricDataResults'])
+    return _response['MetricDataResults'][0]
   except Exception as err:
     _print_stacktrace(err)
     _print_result([_EXIT_UNKNOWN, 'Unknown error getting cloudwatch metric'])
 
 
+def _get_cache_dir():
+  # The cache sits under the shared temp directory; only use it if it is a real directory private to this user
+  os.makedirs(_CACHE_DIR, mode=0o700, exist_ok=True)
+  _dir_stat = os.lstat(_CACHE_DIR)
+  if not stat.S_ISDIR(_dir_stat.st_mode) or _dir_stat.st_uid != os.getuid() or _dir_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+    raise OSError('{dir} is not a private directory owned by this user'.format(dir=_CACHE_DIR))
+  return _CACHE_DIR
+
+
+def _get_cache_file(_args):
+  _cache_args = sorted((_key, _value) for _key, _value in vars(_args).items() if _key not in ('verbose', 'verboseverbose', 'cache_ttl'))
+  _cache_key = hashlib.sha1(repr(('cloudwatch', _cache_args)).encode()).hexdigest()
+  return os.path.join(_get_cache_dir(), '{key}.json'.format(key=_cache_key))
+
+
+def _read_cache(_args):
+  if _args.cache_ttl <= 0:
+    return None
+  try:
+    _cache_file = _get_cache_file(_args)
+    # O_NOFOLLOW + fstat checks the file actually opened, not whatever the path pointed at a moment earlier
+    with os.fdopen(os.open(_cache_file, os.O_RDONLY | os.O_NOFOLLOW)) as _cache:
+      _cache_stat = os.fstat(_cache.fileno())
+      if _cache_stat.st_uid != os.getuid() or time.time() - _cache_stat.st_mtime > _args.cache_ttl:
+        _logger.info('Cache stale or not owned by this user: %s', _cache_file)
+        return None
+      _check_result = json.load(_cache)
+    _logger.info('Check result read from cache: %s', _cache_file)
+    return _check_result
+  except Exception as err:
+    _logger.info('Cache not used: %s', err)
+    return None
+
+
+def _write_cache(_args, _check_result):
+  if _args.cache_ttl <= 0:
+    return
+  try:
+    _cache_file = _get_cache_file(_args)
+    _tmp_fd, _tmp_file = tempfile.mkstemp(dir=os.path.dirname(_cache_file), suffix='.tmp')
+    try:
+      with os.fdopen(_tmp_fd, 'w') as _cache:
+        json.dump(_check_result, _cache, default=str)
+      os.replace(_tmp_file, _cache_file)
+    except Exception:
+      os.unlink(_tmp_file)
+      raise
+    _logger.info('Check result written to cache: %s', _cache_file)
+  except Exception as err:
+    _print_stacktrace(err)
+    _logger.info('Cache not written: %s', err)
+
+
 def _print_result(_result):
   sys.stdout.write('CLOUDWATCH {status} - {info_text}'.format(status=_result[0][1], info_text=_result[1]))
+  if _FAST_EXIT:
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(_result[0][0])
   sys.exit(_result[0][0])
 
 
 def _print_stacktrace(_stacktrace):
   if _PRINT_STACKTRACE_ON_ERROR:
+    import traceback
     traceback.print_exc(file=sys.stderr)
 
 
 def _analyze_result(_args, _check_result):
   _logger.info('Analyze results')
-  _result_txt = '{metric}: {metric_value} {metric_unit} '.format(metric=_args.metric, metric_value=_check_result[0][_args.statistic], metric_unit=_check_result[0]['Unit'])
-  _comparator = getattr(operator, _args.comparator)
-  if _comparator(_check_result[0][_args.statistic], _args.critical):
+  if not _check_result['Values']:
+    return [_EXIT_UNKNOWN, '{metric}: no datapoints in last {period} seconds'.format(metric=_args.metric, period=_args.period)]
+  _comparator = _COMPARATORS[_args.comparator]
+  _metric_value = _check_result['Values'][0]
+  _result_txt = '{metric}: {metric_value}'.format(metric=_args.metric, metric_value=_metric_value)
+  if _args.unit is not None:
+    _result_txt += ' {unit}'.format(unit=_args.unit)
+  if _comparator(_metric_value, _args.critical):
     return [_EXIT_CRITICAL, _result_txt]
-  elif _comparator(_check_result[0][_args.statistic], _args.warning):
+  elif _comparator(_metric_value, _args.warning):
     return [_EXIT_WARNING, _result_txt]
   else:
     return [_EXIT_OK, _result_txt]
@@ -169,8 +276,11 @@ def _analyze_result(_args, _check_result):
 def _main():
   _logger.info('Begin main')
   _args = _get_args()
-  _aws_client = _get_aws_client(_args)
-  _check_result = _get_check_result(_args, _aws_client)
+  _check_result = _read_cache(_args)
+  if _check_result is None:
+    _aws_client = _get_aws_client(_args.aws_region, _args.aws_profile)
+    _check_result = _get_check_result(_args, _aws_client)
+    _write_cache(_args, _check_result)
   _analyzed_result = _analyze_result(_args, _check_result)
   _print_result(_analyzed_result)
   _logger.info('Finish main')
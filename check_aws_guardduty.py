@@ -23,28 +23,40 @@ __license__ = "GPLv2"
 __version__ = "0.1.0"
 
 import argparse
-import boto3
-from datetime import datetime, timedelta
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import hashlib
+import itertools
+import json
+import os
+import stat
 import sys
 import logging
-import traceback
-import operator
+import tempfile
+import time
 
 # Constants
 ###############################################################################
-_STDERR_OUTPUT_LEVEL = logging.DEBUG  # Leave at logging.CRITICAL unless doing debugging
-_PRINT_STACKTRACE_ON_ERROR = True  # Show stacktrace to stderr on error
+_STDERR_OUTPUT_LEVEL = logging.CRITICAL  # Leave at logging.CRITICAL unless doing debugging
+_PRINT_STACKTRACE_ON_ERROR = False  # Show stacktrace to stderr on error
+_FAST_EXIT = True  # Skip interpreter teardown (atexit, open sockets) on exit; set False when debugging
 _EXIT_OK = [0, 'OK']
 _EXIT_WARNING = [1, 'WARNING']
 _EXIT_CRITICAL = [2, 'CRITICAL']
 _EXIT_UNKNOWN = [3, 'UNKNOWN']
+_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'icinga_aws_cache-{uid}'.format(uid=os.getuid()))  # Used when --cache_ttl is greater than 0
+_THREATLIST_FINDING_TYPE = 'UnauthorizedAccess:EC2/MaliciousIPCaller.Custom'  # INBOUND findings of this type are ignored
+_MAX_WORKERS = 32  # Upper bound on GuardDuty calls in flight (multi-detector setups only); also used as max_pool_connections
 
 
 # Functions
 ###############################################################################
 def _get_logger():
   _root_logger = logging.getLogger()
-  _root_logger.setLevel(logging.DEBUG)
+  # Gate on the logger too so disabled debug/info calls return before building a record.  The handler level still
+  # applies to records from library loggers (urllib3, botocore), which only check their own level
+  _root_logger.setLevel(_STDERR_OUTPUT_LEVEL)
   _formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
   _stderr_logger = logging.StreamHandler()
   _stderr_logger.setFormatter(_formatter)
@@ -59,48 +71,68 @@ def _get_logger():
 
 # noinspection DuplicatedCode
 def _get_args():
+  def _set_logging_level(_level):
+    _logger.setLevel(_level)
+    for _handler in _logger.handlers:
+      _handler.setLevel(_level)
+
   def _update_logging_level():
     if _args.verbose:
-      _logger.setLevel(logging.INFO)
+      _set_logging_level(logging.INFO)
       _logger.info('Logger level set to INFO')
     elif _args.debug:
-      _logger.setLevel(logging.DEBUG)
-    _logger.info('Logger level set to DEBUG')
+      _set_logging_level(logging.DEBUG)
+      _logger.info('Logger level set to DEBUG')
     return
 
   try:
     _logger.info('Parse arguments')
     _parser = argparse.ArgumentParser(description='Check an AWS GuardDuty.')
     _parser.add_argument('-P', '--period', metavar='PERIOD', help='Period (HOURS) to go back for updated findings (default: %(default)s)', dest='period', type=int, default=48)
-    # ToDo: Failed attempt to filter inbound connections
-    # _parser.add_argument('-C', '--criterion', metavar='CRITERION', help='Comma separated list of Criterion FIELD,COMPARATOR,VALUE.  May be called multiple times. (Example: type,NotEquals,UnauthorizedAccess:EC2/MaliciousIPCaller.Custom)', dest='criterion', type=str, nargs='*')
+    _parser.add_argument('-x', '--finding_type_exclude', metavar='FINDING-TYPES', action='store', help='Comma separated list of finding types to ignore (Example: Recon:EC2/PortProbeUnprotectedPort)', dest='finding_type_exclude', type=str)
     _parser.add_argument('-w', '--warning', metavar='WARNING', action='store', help='Value (INT) for WARNING if any findings with severity greater than', dest='warning', type=int, default=4)
     _parser.add_argument('-c', '--critical', metavar='CRITICAL', action='store', help='Value (INT) for CRITICAL if any findings with severity greater than', dest='critical', type=int, default=7)
     _parser.add_argument('-r', '--aws_region', metavar='AWS_REGION', required=True, action='store', help='AWS region (Example: us-east-1)', dest='aws_region', type=str)
     _parser.add_argument('-p', '--aws_profile', metavar='AWS_PROFILE', action='store', help='AWS profile', dest='aws_profile', type=str)
+    _parser.add_argument('-t', '--cache_ttl', metavar='CACHE_TTL', action='store', help='Seconds (INT) to reuse a cached AWS response; 0 disables the cache (default: %(default)s)', dest='cache_ttl', type=int, default=0)
     _parser.add_argument('-v', '--verbose', required=False, action='store_true', help='Verbose output to stderr', dest='verbose')
     _parser.add_argument('-vv', '--debug', required=False, action='store_true', help='Debug output to stderr', dest='debug')
     _args = _parser.parse_args()
     _update_logging_level()
-    _logger.debug('Args: {0}'.format(vars(_args)))
+    _logger.debug('Args: %s', vars(_args))
     return _args
   except Exception as err:
     _print_stacktrace(err)
     _print_result([_EXIT_UNKNOWN, 'Unknown error parsing arguments'])
 
 
-def _get_aws_client(_args):
+# Cached so repeated _main() calls in a long-lived process reuse the session and its connection pool
+@functools.lru_cache(maxsize=8)
+def _get_aws_client(_aws_region, _aws_profile):
   try:
     _logger.info('Get AWS client')
+    # Imported here so --help and argument errors don't pay for loading boto3
+    import boto3
+    from botocore.config import Config
     _session_args = {
-      'region_name': _args.aws_region
+      'region_name': _aws_region
     }
-    if hasattr(_args, 'aws_profile'):
-      _session_args['profile_name'] = _args.aws_profile
-
-    _logger.debug('Session args: {0}'.format(_session_args))
+    if _aws_profile is not None:
+      _session_args['profile_name'] = _aws_profile
+
+    _logger.debug('Session args: %s', _session_args)
+    _client_config = Config(
+      tcp_keepalive=True,
+      max_pool_connections=_MAX_WORKERS,
+      connect_timeout=3,
+      read_timeout=10,
+      retries={
+        'max_attempts': 5,
+        'mode': 'adaptive'
+      }
+    )
     _session = boto3.Session(**_session_args)
-    _client = _session.client(service_name='guardduty')
+    _client = _session.client(service_name='guardduty', config=_client_config)
     _logger.info('AWS client created')
     return _client
   except Exception as err:
@@ -112,61 +144,84 @@ def _get_check_result(_args, _aws_client):
   def _get_detector_ids():
     _logger.info('Get detector IDs')
     _request_args = {
-      'MaxResults': 50
+      'PaginationConfig': {
+        'PageSize': 50
+      }
     }
-    _response = _aws_client.list_detectors(**_request_args)
-    _logger.debug('Response Detectors: {0}'.format(_response['DetectorIds']))
-    return _response['DetectorIds']
+    _paginator = _aws_client.get_paginator('list_detectors')
+    _pages = _paginator.paginate(**_request_args)
+    _detector_ids = list(itertools.chain.from_iterable(_page['DetectorIds'] for _page in _pages))
+    _logger.debug('Response Detectors: %s', _detector_ids)
+    return _detector_ids
 
-  def _get_findings():
-    _findings_details = []
-    for _detector in _detector_ids:
-      _detector_findings = []
-      _logger.info('Get Findings for Detector {id}'.format(id=_detector))
-      # ToDo: Figure out how to filter on archived - https://github.com/boto/boto3/issues/1746
-      _request_args = {
-        'DetectorId': _detector,
-        'MaxResults': 50,
-        'FindingCriteria': {
-          'Criterion': {
-            'updatedAt': {
-              'GreaterThanOrEqual': int((datetime.utcnow() - timedelta(hours=_args.period)).timestamp()) * 1000
-            },
-            'severity': {
-              'GreaterThanOrEqual': _args.warning
-            }
-          }
-        }
+  def _get_severity_counts(_detector, _criterion):
+    _request_args = {
+      'DetectorId': _detector,
+      'FindingStatisticTypes': ['COUNT_BY_SEVERITY'],
+      'FindingCriteria': {
+        'Criterion': _criterion
       }
-      # ToDo: Failed attempt to filter inbound connections
-      # if _args.finding_type_exclude is not None:
-      #   _request_args['FindingCriteria']['Criterion']['type'] = {
-      #     'NotEquals': []
-      #   }
-      #   for _finding_type in _args.finding_type_exclude.split(','):
-      #     _request_args['FindingCriteria']['Criterion']['type']['NotEquals'].append(_finding_type)
-
-      while True:
-        _logger.debug('ListFindings Args: {args}'.format(args=_request_args))
-        _response = _aws_client.list_findings(**_request_args)
-        _logger.debug('Response GuardDuty Findings: {0}'.format(_response))
-        _detector_findings.extend(_response['FindingIds'])
-        if 'NextToken' in _response and _response['NextToken'] != '':
-          _request_args['NextToken'] = _response['NextToken']
-        else:
-          break
-
-      _request_args = {
-        'DetectorId': _detector,
-        'FindingIds': _detector_findings
+    }
+    _logger.debug('GetFindingsStatistics Args: %s', _request_args)
+    _response = _aws_client.get_findings_statistics(**_request_args)
+    _logger.debug('Response GuardDuty Statistics: %s', _response['FindingStatistics'])
+    return Counter({float(_severity): _count for _severity, _count in _response['FindingStatistics']['CountBySeverity'].items()})
+
+  def _get_criteria():
+    _criterion = {
+      'updatedAt': {
+        'GreaterThanOrEqual': _cutoff
+      },
+      'severity': {
+        'GreaterThanOrEqual': _args.warning
+      },
+      'service.archived': {
+        'Equals': ['false']
       }
-      _response = _aws_client.get_findings(**_request_args)
-      _logger.debug('Findings Details: {0}'.format(_response['Findings']))
-      _findings_details.extend(_response['Findings'])
+    }
+    _excluded_types = []
+    if _args.finding_type_exclude is not None:
+      _excluded_types = [_finding_type.strip() for _finding_type in _args.finding_type_exclude.split(',') if _finding_type.strip()]
+    if _excluded_types:
+      _criterion['type'] = {
+        'NotEquals': _excluded_types
+      }
+
+    # INBOUND connections from the threatlist are noise.  Criteria can only be AND'ed, so count them separately and
+    # subtract rather than excluding the finding type outright (OUTBOUND connections to the threatlist still count)
+    if _THREATLIST_FINDING_TYPE in _excluded_types:
+      return _criterion, None
+    _noise_criterion = dict(_criterion)
+    _noise_criterion['type'] = {
+      'Equals': [_THREATLIST_FINDING_TYPE]
+    }
+    _noise_criterion['service.action.networkConnectionAction.connectionDirection'] = {
+      'Equals': ['INBOUND']
+    }
+    return _criterion, _noise_criterion
 
-    return _findings_details
+  def _get_detector_severity_counts(_detector):
+    _logger.info('Get Findings for Detector %s', _detector)
+    _detector_counts = _get_severity_counts(_detector, _criterion)
+    # Healthy detectors (the common case) have nothing actionable, so there is no noise to subtract
+    if _detector_counts and _noise_criterion is not None:
+      _detector_counts -= _get_severity_counts(_detector, _noise_criterion)
+    return _detector_counts
+
+  def _get_findings():
+    _severity_counts = Counter()
+    if not _detector_ids:
+      return _severity_counts
+    # GuardDuty allows one detector per account per region, so this is usually a single call; the pool only
+    # overlaps requests for delegated-admin or multi-detector setups.  The boto3 client is safe to share across threads
+    with ThreadPoolExecutor(max_workers=min(_MAX_WORKERS, len(_detector_ids))) as _executor:
+      for _detector_counts in _executor.map(_get_detector_severity_counts, _detector_ids):
+        _severity_counts.update(_detector_counts)
+    return _severity_counts
 
   try:
+    _cutoff = int((time.time() - _args.period * 3600) * 1000)
+    _criterion, _noise_criterion = _get_criteria()
     _detector_ids = _get_detector_ids()
     _findings = _get_findings()
     return _findings
@@ -175,53 +230,92 @@ def _get_check_result(_args, _aws_client):
     _print_result([_EXIT_UNKNOWN, 'Unknown error getting findings'])
 
 
+def _get_cache_dir():
+  # The cache sits under the shared temp directory; only use it if it is a real directory private to this user
+  os.makedirs(_CACHE_DIR, mode=0o700, exist_ok=True)
+  _dir_stat = os.lstat(_CACHE_DIR)
+  if not stat.S_ISDIR(_dir_stat.st_mode) or _dir_stat.st_uid != os.getuid() or _dir_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+    raise OSError('{dir} is not a private directory owned by this user'.format(dir=_CACHE_DIR))
+  return _CACHE_DIR
+
+
+def _get_cache_file(_args):
+  _cache_args = sorted((_key, _value) for _key, _value in vars(_args).items() if _key not in ('verbose', 'debug', 'cache_ttl'))
+  _cache_key = hashlib.sha1(repr(('guardduty', _cache_args)).encode()).hexdigest()
+  return os.path.join(_get_cache_dir(), '{key}.json'.format(key=_cache_key))
+
+
+def _read_cache(_args):
+  if _args.cache_ttl <= 0:
+    return None
+  try:
+    _cache_file = _get_cache_file(_args)
+    # O_NOFOLLOW + fstat checks the file actually opened, not whatever the path pointed at a moment earlier
+    with os.fdopen(os.open(_cache_file, os.O_RDONLY | os.O_NOFOLLOW)) as _cache:
+      _cache_stat = os.fstat(_cache.fileno())
+      if _cache_stat.st_uid != os.getuid() or time.time() - _cache_stat.st_mtime > _args.cache_ttl:
+        _logger.info('Cache stale or not owned by this user: %s', _cache_file)
+        return None
+      _check_result = Counter({float(_severity): _count for _severity, _count in json.load(_cache).items()})
+    _logger.info('Check result read from cache: %s', _cache_file)
+    return _check_result
+  except Exception as err:
+    _logger.info('Cache not used: %s', err)
+    return None
+
+
+def _write_cache(_args, _check_result):
+  if _args.cache_ttl <= 0:
+    return
+  try:
+    _cache_file = _get_cache_file(_args)
+    _tmp_fd, _tmp_file = tempfile.mkstemp(dir=os.path.dirname(_cache_file), suffix='.tmp')
+    try:
+      with os.fdopen(_tmp_fd, 'w') as _cache:
+        json.dump(_check_result, _cache, default=str)
+      os.replace(_tmp_file, _cache_file)
+    except Exception:
+      os.unlink(_tmp_file)
+      raise
+    _logger.info('Check result written to cache: %s', _cache_file)
+  except Exception as err:
+    _print_stacktrace(err)
+    _logger.info('Cache not written: %s', err)
+
+
 def _print_result(_result):
-  sys.stdout.write('AWS-BACKUP {status} - {info_text}'.format(status=_result[0][1], info_text=_result[1]))
+  sys.stdout.write('AWS-GUARDDUTY {status} - {info_text}'.format(status=_result[0][1], info_text=_result[1]))
+  if _FAST_EXIT:
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(_result[0][0])
   sys.exit(_result[0][0])
 
 
 def _print_stacktrace(_stacktrace):
   if _PRINT_STACKTRACE_ON_ERROR:
+    import traceback
     traceback.print_exc(file=sys.stderr)
 
 
 def _analyze_result(_args, _check_result):
-  def _ignore_finding():
-    # ToDo: this is a hackish way to filter INBOUND connections from the threatlist.  Need better way to filter
-    if _result['Type'] == 'UnauthorizedAccess:EC2/MaliciousIPCaller.Custom' and \
-            _result['Service']['Action']['NetworkConnectionAction']['ConnectionDirection'] == 'INBOUND':
-      _logger.debug('Ignore FindingId: {id}'.format(id=_result['Id']))
-      # This is an INBOUND connection from threatlist - noise...
-      return True
-    else:
-      return False
   _logger.info('Analyze results')
-  _result_counts = {
-    'Critical': {
-      'Severity': _args.critical,
-      'Count': 0
-    },
-    'Warning': {
-      'Severity': _args.warning,
-      'Count': 0
-    }
-  }
-  _logger.debug('Total Findings: {0}'.format(len(_check_result)))
-  for _result in _check_result:
-    _logger.debug('FindingId: {id}  Severity:{severity}  LastSeen: {lastseen}  Description: {desc}'.format(id=_result['Id'], severity=_result['Severity'], lastseen=_result['Service']['EventLastSeen'] ,desc=_result['Description']))
-    if _result['Service']['Archived']:
-      continue
-    elif _ignore_finding():
-      continue
-    if _result['Severity'] > _args.critical:
-      _result_counts['Critical']['Count'] += 1
-    elif _result['Severity'] > _args.warning:
-      _result_counts['Warning']['Count'] += 1
-
-  _result_txt = '{count} in last {period} hours'.format(count=_result_counts, period=_args.period)
-  if _result_counts['Critical']['Count'] > 0:
+  _logger.debug('Findings by Severity: %s', _check_result)
+  _critical = _args.critical
+  _warning = _args.warning
+  _critical_count = 0
+  _warning_count = 0
+  for _severity, _count in _check_result.items():
+    if _severity > _critical:
+      _critical_count += _count
+    elif _severity > _warning:
+      _warning_count += _count
+
+  _result_txt = '{critical_count} critical (severity > {critical}), {warning_count} warning (severity > {warning}) in last {period} hours'.format(
+    critical_count=_critical_count, critical=_critical, warning_count=_warning_count, warning=_warning, period=_args.period)
+  if _critical_count > 0:
     return [_EXIT_CRITICAL, _result_txt]
-  elif _result_counts['Warning']['Count'] > 0:
+  elif _warning_count > 0:
     return [_EXIT_WARNING, _result_txt]
   else:
     return [_EXIT_OK, _result_txt]
@@ -232,8 +326,11 @@ def _analyze_result(_args, _check_result):
 def _main():
   _logger.info('Begin main')
   _args = _get_args()
-  _aws_client = _get_aws_client(_args)
-  _check_result = _get_check_result(_args, _aws_client)
+  _check_result = _read_cache(_args)
+  if _check_result is None:
+    _aws_client = _get_aws_client(_args.aws_region, _args.aws_profile)
+    _check_result = _get_check_result(_args, _aws_client)
+    _write_cache(_args, _check_result)
   _analyzed_result = _analyze_result(_args, _check_result)
   _print_result(_analyzed_result)
   _logger.info('Finish main')